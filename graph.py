@@ -3,7 +3,6 @@
 # Copyright (c) 2014 Peter Hornyack
 
 import re
-from collections import deque
 
 # How should we represent the graph once we have read in the edge list?
 # There are two basic structures for representing a graph: an adjacency
@@ -17,6 +16,16 @@ from collections import deque
 # sophisticated structures out there, but that's probably overkill for
 # now.
 #
+# One such structure is a sparse (e.g. SciPy CSR) matrix, which would
+# let us find all of the candidates for removal with a couple of
+# vectorized calls and eliminate them with sparse matrix products. But
+# candidates can't simply all be eliminated at once: in a chain or
+# cycle of candidates, each removal changes its neighbors' edges, and
+# connecting neighbors that are already connected changes their edge
+# counts, so eliminating them in bulk would need several rounds with
+# careful fixups. It would also add the program's first dependency
+# outside the standard library, so we stick with adjacency sets.
+#
 # How should we hold the edge lists? A map/dict using the edge ID as
 # the key seems simple and efficient. In the reduce algorithm we will
 # need to know the counts of both incoming and outgoing edges for each
@@ -25,16 +34,59 @@ from collections import deque
 # list for outgoing edges and then just a count of incoming edges for
 # each node? It seems like either could work, but keeping both lists
 # should reduce the number of lookups needed during the reduce algorithm.
+# Rather than keeping the two lists in two separate maps, though, keep
+# a single map from each node to an (inedges, outedges) pair: the reduce
+# algorithm always needs both lists for a node, and this way it can get
+# them with one lookup instead of two.
+#
+# Node IDs in the input are arbitrary strings, but hashing and comparing
+# strings on every edge operation is relatively expensive. Each node is
+# therefore numbered in the order it is first seen while reading the
+# input, and the graph is kept in terms of these numbers: the adjacency
+# "map" is simply a list indexed by node number, and the edge sets hold
+# small ints. The strings are only needed again when writing the output.
+# Renumbering the nodes afterwards (e.g. with Reverse Cuthill-McKee) so
+# that neighbors get nearby numbers doesn't seem worthwhile: the edge
+# sets are separate heap objects wherever they are in the list, so the
+# ordering buys little cache locality, and computing it in Python would
+# cost about as much as the reduce itself.
+#
+# Edge tests and deletions turn out to be common during the reduce
+# algorithm, and with plain lists they cost O(degree) each, which is
+# quadratic for high-degree nodes. The edge "lists" are therefore kept
+# as sets, which makes adding, testing and removing an edge O(1).
 #
 # Future enhancements:
-#   Possibly use a sorted list or binary tree for the edge lists, if
-#     edge tests or deletions are common.
+#   Reduce independent parts of the graph in parallel? Candidates whose
+#     neighborhoods don't overlap could be removed by a pool of worker
+#     threads, locking the node and its neighbors (in node-number order,
+#     to avoid deadlock) before touching their edge sets. This only pays
+#     off without the GIL (a free-threaded build, or the reduce loop
+#     ported to C/Cython): the loop is pure Python set operations, so
+#     with the GIL the locking overhead would make it slower.
 #   Create a separate class for the edge lists as well?
 #   Define better exceptions.
 
 # Assumption: node IDs contain one or more alphanumeric characters or
 # underscores.
-EDGE_RE = re.compile(r"^(?P<start>\w+)\t(?P<end>\w+)$")
+# Matches at the start of any line that is not a valid edge line, so a
+# single search() over the whole input finds the first invalid line.
+# (Matching the whole input against a repeated edge-line pattern would
+# also work, but the regex engine keeps state for every repetition, so
+# its memory use grows with the number of lines.)
+BAD_LINE_RE = re.compile(r"^(?!\w+\t\w+$)", re.M)
+
+# Indices of the incoming and outgoing edge sets in each node's entry
+# in the adjacency list.
+IN = 0
+OUT = 1
+
+# Number of edges to write to the output file at once.
+WRITE_CHUNK = 1 << 16
+
+# Minimum number of checked nodes to drop from the front of the reduce
+# candidates list at once.
+COMPACT_MIN = 1024
 
 class Graph:
     """Class representing a directed graph. The representation kept
@@ -43,103 +95,126 @@ class Graph:
     needed for a basic directed graph.
     """
 
-    outedges = None
-    inedges = None
+    # Use slots rather than a per-instance dict: attribute access is a
+    # bit faster, and each Graph is a bit smaller.
+    __slots__ = ('adj', 'names', 'ids')
 
     def __init__(self):
+        self.adj = list()
+        self.names = list()
+        self.ids = dict()
         return
 
+    def node_id(self, name):
+        """Returns the node number for the node with the specified
+        name, adding a new node with no edges if there is not one
+        already.
+        """
+        node = self.ids.get(name)
+        if node is None:
+            node = len(self.names)
+            self.ids[name] = node
+            self.names.append(name)
+            self.adj.append((set(), set()))
+        return node
+
     def add_directed_edge(self, start, end):
-        """Adds an edge from start to end. Duplicate edges are
-        ignored. Returns 1 if there was already an edge between
-        start and end, otherwise returns 0.
+        """Adds an edge from start to end, which are node numbers
+        returned by node_id(). Duplicate edges are ignored. Returns 1
+        if there was already an edge between start and end, otherwise
+        returns 0.
         """
         # Does this handle self-edges? Yes.
-        exists_out = self._add_edge(self.outedges, start, end)
-        exists_in  = self._add_edge(self.inedges, end, start)
-        assert(exists_out == exists_in)
-        return exists_out
-
-    def _add_edge(self, edgemap, start, end):
-        """Adds an edge from 'start' to 'end' in the specified edge
-        map. Duplicate edges are ignored. Returns 1 if there was
-        already an edge between start and end, otherwise returns 0.
-        """
-        try:
-            edgelist = edgemap[start]
-        except KeyError:
-            edgelist = list()
-            edgemap[start] = edgelist
-
-        # For now, just use a basic list for the edge lists. In the
-        # future, if tests to check for edge presence or edge deletions
-        # are frequent operations, then a sorted list or BST may be
-        # more appropriate.
-        if end in edgelist:
+        outedges = self.adj[start][OUT]
+        if end in outedges:
             return 1
-        edgelist.append(end)
+        outedges.add(end)
+        self.adj[end][IN].add(start)
         return 0
 
     def del_directed_edge(self, start, end):
-        """Removes an edge from start to end. If there is no edge from
-        start to end, raises a KeyError.
+        """Removes an edge from start to end, which are node numbers
+        returned by node_id(). If there is no edge from start to end,
+        raises a KeyError.
         """
         # Does this handle self-edges? Yes.
-        self._del_edge(self.outedges, start, end)
-        self._del_edge(self.inedges, end, start)
-        return
-
-    def _del_edge(self, edgemap, start, end):
-        """Removes an edge from 'start' to 'end' in the specified
-        edge map. If there is no edge from start to end, raises a
-        KeyError.
-        """
         try:
-            edgelist = edgemap[start]
-        except KeyError:
-            edgelist = []
-        try:
-            idx = edgelist.index(end)
-        except ValueError:
+            self.adj[start][OUT].remove(end)
+        except (KeyError, IndexError):
             raise KeyError("no edge {}<->{}".format(start, end))
-
-        edgelist.pop(idx)
-        if len(edgelist) == 0:
-            edgemap.pop(start)
+        self.adj[end][IN].remove(start)
         return
 
     def from_file(self, infile):
-        """Reads edge lines from the open file and fills the edge
-        maps. Raises ValueError if an invalid line is encountered.
+        """Reads the remaining edge lines from the open file and fills
+        the edge sets. Raises ValueError if an invalid line is
+        encountered.
         """
-        # For now, just reset these every time this method is called.
-        self.outedges = dict()
-        self.inedges = dict()
+        # Read the whole input at once and validate it with a single
+        # regex scan, rather than calling readline() and matching a
+        # regex for every line; the per-line interpreter overhead
+        # dominates the parsing time for large edge lists. (Mapping the
+        # file with mmap wouldn't help: splitting the input into node
+        # IDs needs a string anyway, and stdin is usually a pipe.)
+        data = infile.read()
+        if data:
+            # The last line may end with a newline; don't search past it,
+            # or the empty "line" after it would count as invalid.
+            end = len(data) - 1 if data.endswith('\n') else len(data)
+            bad_match = BAD_LINE_RE.search(data, 0, end)
+            if bad_match:
+                start = bad_match.start()
+                stop = data.find('\n', start) + 1 or len(data)
+                raise ValueError("invalid input line {}".format(
+                                 data[start:stop]))
 
-        line = infile.readline()
-        while line:
-            edge_match = EDGE_RE.match(line)
-            if not edge_match:
-                raise ValueError("invalid input line {}".format(line))
-            start = edge_match.group('start')
-            end = edge_match.group('end')
+        # Once the input is known to be valid, node IDs are exactly the
+        # runs of non-whitespace characters, so one split() of the whole
+        # input yields the start and end of every edge in turn.
+        tokens = data.split()
 
-            # Note: we don't add empty lists to the outedges and
-            # inedges maps here, so nodes that have only input edges
-            # or only output edges may not be found in one of the maps!
-            self.add_directed_edge(start, end)
+        # Number all of the nodes up front, replacing any graph we had
+        # before. dict.fromkeys() keeps the first occurrence of each name
+        # in order, so this gives the same numbering as calling node_id()
+        # for each name in turn, but the maps and adjacency list are
+        # built at their final size in one go, rather than being grown
+        # (and rehashed) one node at a time.
+        self.names = list(dict.fromkeys(tokens))
+        self.ids = dict(zip(self.names, range(len(self.names))))
+        self.adj = [(set(), set()) for _ in self.names]
 
-            line = infile.readline()
+        # Add the edges directly to the edge sets rather than
+        # calling add_directed_edge() for each one: there is no need
+        # to check for duplicates here, since the sets ignore them,
+        # and this saves a method call per edge.
+        # Note: a node that has only input edges or only output
+        # edges will have an empty set for the other direction.
+        adj = self.adj
+        nodes = map(self.ids.__getitem__, tokens)
+        for (start, end) in zip(nodes, nodes):
+            adj[start][OUT].add(end)
+            adj[end][IN].add(start)
 
         return
 
     def to_file(self, outfile):
-        """Writes edges from the outgoing edge map to the specified
+        """Writes edges from the outgoing edge sets to the specified
         open writeable file. The order of edges is arbitrary.
         """
-        for (start, edgelist) in self.outedges.items():
-            for end in edgelist:
-                outfile.write("{}\t{}\n".format(start, end))
+        # Calling write() once per edge is slow for large graphs, so
+        # join the lines into chunks of WRITE_CHUNK edges and write
+        # each chunk at once; chunking keeps the memory needed for the
+        # joined string bounded.
+        names = self.names
+        lines = []
+        for (start, edges) in enumerate(self.adj):
+            start_name = names[start]
+            lines.extend(f"{start_name}\t{names[end]}\n"
+                         for end in edges[OUT])
+            if len(lines) >= WRITE_CHUNK:
+                outfile.write(''.join(lines))
+                lines = []
+        outfile.write(''.join(lines))
 
         return
 
@@ -180,50 +255,153 @@ class Graph:
         #   Once the candidate queue is empty, we are done: we have checked
         #   all of the nodes at least once, and we double-checked nodes
         #   whose input/output edge count changed.
+        #
+        # Long chains of candidates (A->B->C->...) are common, and
+        # removing them one node at a time means repeatedly connecting
+        # a neighbor to the next node of the chain, only to delete that
+        # edge again. Instead, when we find a candidate we follow its
+        # edges back and forward to find the whole chain of candidates
+        # it belongs to, remove the entire chain at once, and connect
+        # the nodes on either side of it directly. Only this final
+        # connection can find the neighbors already connected: every
+        # node in the chain has just the one input edge, from the node
+        # before it. If the chain turns out to be an isolated cycle,
+        # the whole cycle is removed, as if it were reduced one node at
+        # a time.
 
-        # Use a deque rather than a list for candidates: supports faster
-        # pops / appends at both ends. Note that this list will not
-        # actually include nodes that only have input edges; this is
-        # ok (and is in fact a bit of an optimization), because they will
-        # definitely not be candidates for removal.
-        candidates = deque(self.outedges.keys())
-
-        while len(candidates) > 0:
-            node = candidates.popleft()
-
-            # We could possibly reduce the number of lookups here by
-            # keeping just one map and storing a tuple of (outedges,
-            # inedges) as the value for each node. I actually started
-            # to refactor the code to do this, but the edge add /
-            # delete methods got pretty messy, so leave this as two
-            # separate map lookups for now. We also perform lookups
-            # in the add/delete edge methods that duplicate lookups
-            # we just performed here; these could potentially be
-            # optimized away too.
-            try:
-                outedges = self.outedges[node]
-            except KeyError:
-                outedges = []
-            try:
-                inedges = self.inedges[node]
-            except KeyError:
-                inedges = []
-
-            if len(outedges) == 1 and len(inedges) == 1:
-                nbr_in  = inedges[0]
-                nbr_out = outedges[0]
-                self.del_directed_edge(nbr_in, node)
-                if node == nbr_out:
-                    # Isolated self-cycles: don't try to delete the edge
-                    # a second time, and don't try to add back a new edge.
-                    pass
-                else:
-                    self.del_directed_edge(node, nbr_out)
-                    already_connected = self.add_directed_edge(nbr_in,
-                                                               nbr_out)
-                    if already_connected == 1:
-                        candidates.append(nbr_in)
-                        candidates.append(nbr_out)
+        # Only seed the queue of candidates with nodes that have exactly
+        # one input and one output edge right now: removing a node leaves
+        # its neighbors' edge counts unchanged unless they were already
+        # connected, and in that case both neighbors are appended to the
+        # queue by _reduce() anyway, so no other node can become a
+        # candidate later on.
+        #
+        # This scan is a small fraction of the reduce time, so there is
+        # no point keeping separate degree counts (e.g. in NumPy arrays)
+        # to vectorize it: they would have to be updated on every edge
+        # addition and deletion.
+        candidates = [node for (node, edges) in enumerate(self.adj)
+                      if len(edges[IN]) == 1 and len(edges[OUT]) == 1]
+
+        _reduce(self.adj, candidates)
 
         return
 
+def _reduce(adj, candidates):
+    """Removes the nodes in the candidates list that have exactly one
+    input and one output edge from the adjacency list, directly
+    connecting their neighbors, and appending to the list any nodes
+    that must be checked again, until every node in the list has been
+    checked. This is the inner loop of Graph.reduce_graph().
+    """
+    # This loop is where nearly all of the reduce time goes, so it is
+    # kept as a plain function over the node-number adjacency list, with
+    # the edge deletions and addition done directly on the edge sets:
+    # no method calls or attribute lookups on the Graph are needed for
+    # each node. (This is also the shape a JIT compiler such as Numba
+    # would want, but Numba cannot compile a list of pairs of sets and
+    # this program should not need anything outside the standard
+    # library, so plain Python it is.)
+    #
+    # The candidates list is used as a queue by keeping the index of
+    # its head, rather than using a deque: nodes are only ever appended
+    # at the end and taken from the front, and a list with an index does
+    # that without the deque's block bookkeeping. The nodes already
+    # checked are dropped from the front of the list once they make up
+    # most of it (and there are enough of them to be worth the copy).
+    #
+    # Bind the list's append method and COMPACT_MIN to locals up front,
+    # and get edge sets by unpacking rather than by indexing with IN /
+    # OUT, so that the loop body only loads locals rather than looking
+    # up attributes and globals. The list is only measured a second
+    # time to decide on compacting it once enough nodes have been
+    # checked.
+    #
+    # A node may be appended to the queue again while it is still
+    # waiting in it; keep the set of queued nodes so that it is only
+    # checked once, since it will see its latest edge counts anyway.
+    append = candidates.append
+    compact_min = COMPACT_MIN
+    queued = set(candidates)
+    head = 0
+    while head < len(candidates):
+        node = candidates[head]
+        head += 1
+        if head > compact_min:
+            if head * 2 > len(candidates):
+                del candidates[:head]
+                head = 0
+        queued.discard(node)
+
+        # Nodes that were removed earlier are left in the adjacency
+        # list with empty edge sets.
+        (inedges, outedges) = adj[node]
+        if len(outedges) != 1 or len(inedges) != 1:
+            continue
+
+        # Walk back along the chain of candidates to find its first
+        # node and the node before it.
+        first = node
+        (before,) = inedges
+        while before != node:
+            (before_in, before_out) = adj[before]
+            if len(before_out) != 1 or len(before_in) != 1:
+                break
+            first = before
+            (before,) = before_in
+
+        if before == node:
+            # Isolated cycle (including a self-cycle): every node in it
+            # is a candidate, so remove all of them.
+            cur = node
+            while True:
+                (cur_in, cur_out) = adj[cur]
+                (nxt,) = cur_out
+                cur_in.clear()
+                cur_out.clear()
+                if nxt == node:
+                    break
+                cur = nxt
+            continue
+
+        # Walk forward to find the last node of the chain and the node
+        # after it. This can't loop back into the chain, since the only
+        # input edge of each node in the chain is from the node before
+        # it, and the node before the first one is not a candidate.
+        last = node
+        (after,) = outedges
+        while True:
+            (after_in, after_out) = adj[after]
+            if len(after_out) != 1 or len(after_in) != 1:
+                break
+            last = after
+            (after,) = after_out
+
+        # Remove the chain, then connect the nodes on either side.
+        cur = first
+        while True:
+            (cur_in, cur_out) = adj[cur]
+            (nxt,) = cur_out
+            cur_in.clear()
+            cur_out.clear()
+            if cur == last:
+                break
+            cur = nxt
+        (_, before_outedges) = adj[before]
+        (after_inedges, _) = adj[after]
+        before_outedges.remove(first)
+        after_inedges.remove(last)
+        if after in before_outedges:
+            # Already connected: both neighbors have one fewer edge
+            # now, so check them again.
+            if before not in queued:
+                append(before)
+                queued.add(before)
+            if after not in queued:
+                append(after)
+                queued.add(after)
+        else:
+            before_outedges.add(after)
+            after_inedges.add(before)
+
+    return
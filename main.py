@@ -6,6 +6,7 @@
 
 from graph import Graph
 import argparse
+import gc
 import sys
 
 ##############################################################################
@@ -32,8 +33,26 @@ if __name__ == '__main__':
     # Use a separate class for Graph - its internal representation will
     # be just a dict, but class is useful if we later want to add any
     # metadata etc.
+    #
+    # There's no need to reopen stdin / stdout with bigger buffers or a
+    # cheaper encoding: from_file() reads all of stdin with a single
+    # read() call, and to_file() writes the output in chunks of 64K
+    # edges, so the streams' buffering overhead is negligible.
     graph = Graph()
+
+    # Building the graph allocates two sets for every node, and each of
+    # these allocations counts towards triggering the cyclic garbage
+    # collector, which then repeatedly traverses all of the sets built
+    # so far. None of them can be garbage yet, so turn the collector off
+    # while reading the graph, and then move everything to the
+    # collector's permanent generation so that later collections (e.g.
+    # during the reduce) don't traverse the whole graph either: the
+    # edge sets only hold ints, so they can never be part of a
+    # reference cycle anyway.
+    gc.disable()
     graph.from_file(sys.stdin)
+    gc.freeze()
+    gc.enable()
     graph.reduce_graph()
     graph.to_file(sys.stdout)
 